@@ -1,3 +1,4 @@
+import os
 import pytest
 import shutil
 import tempfile
@@ -97,3 +98,113 @@ def test_trimmer():
     # Assert that the functional pipeline remove all the anatomical nodes,
     # as they were already computed
     assert set(func_derivatives.keys()).intersection(set(anat_derivatives.keys())) == set()
+
+
+def _passthrough(in1=None, in2=None):
+    return in1, in2
+
+
+def _trimmer_workflow(tmp_path, connections, cached):
+    '''Build a workflow of Function nodes and DataSinks writing to
+    ``tmp_path``, with one output file for each cached derivative
+
+    (IdentityInterface nodes would be dropped when the graph is expanded)
+    '''
+    from nipype.interfaces.utility import Function
+    from CPAC.pipeline import nipype_pipeline_engine as pe
+    from CPAC.utils.interfaces.datasink import DataSink
+
+    wf = pe.Workflow(name='trimmer_wf')
+    nodes = {}
+
+    def get_node(name):
+        if name not in nodes:
+            if name.startswith('datasink'):
+                nodes[name] = pe.Node(DataSink(), name=name)
+                nodes[name].inputs.base_directory = str(tmp_path)
+                nodes[name].inputs.container = 'sub-1'
+            else:
+                nodes[name] = pe.Node(Function(
+                    input_names=['in1', 'in2'],
+                    output_names=['out', 'out2'],
+                    function=_passthrough), name=name)
+        return nodes[name]
+
+    for src, src_field, dst, dst_field in connections:
+        wf.connect(get_node(src), src_field, get_node(dst), dst_field)
+
+    for derivative in cached:
+        os.makedirs(os.path.join(tmp_path, 'sub-1', derivative))
+        open(os.path.join(tmp_path, 'sub-1', derivative, 'out.txt'),
+             'a').close()
+
+    return wf
+
+
+def test_trimmer_prunes_cached_chain(tmp_path):
+    '''[node1] → [node2] → [node3] → [datasink to file1 ✔]
+               ↳ [node4] → [datasink to file2 ❌]'''
+    from CPAC.utils.trimmer import the_trimmer
+
+    wf = _trimmer_workflow(tmp_path, [
+        ('node1', 'out', 'node2', 'in1'),
+        ('node2', 'out', 'node3', 'in1'),
+        ('node3', 'out', 'datasink1', 'file1'),
+        ('node1', 'out', 'node4', 'in1'),
+        ('node4', 'out', 'datasink2', 'file2'),
+    ], cached=['file1'])
+
+    wf_new, (replacement_mapping, deletions) = the_trimmer(wf)
+
+    assert {n.name for n in wf_new._graph.nodes()} == {
+        'node1', 'node4', 'datasink2'}
+    assert {n.name for n in deletions} == {'datasink1', 'node3', 'node2'}
+    assert replacement_mapping == {}
+
+
+def test_trimmer_keeps_partially_cached_node(tmp_path):
+    '''[registration] →(out)→ [datasink to warped ✔]
+                      ↳(out2)→ [apply] → [datasink to func_warped ❌]'''
+    from CPAC.utils.trimmer import the_trimmer
+
+    wf = _trimmer_workflow(tmp_path, [
+        ('registration', 'out', 'datasink1', 'warped'),
+        ('registration', 'out2', 'apply', 'in1'),
+        ('functional', 'out', 'apply', 'in2'),
+        ('apply', 'out', 'datasink2', 'func_warped'),
+    ], cached=['warped'])
+
+    wf_new, (replacement_mapping, deletions) = the_trimmer(wf)
+
+    assert {n.name for n in wf_new._graph.nodes()} == {
+        'registration', 'functional', 'apply', 'datasink2'}
+    assert {n.name for n in deletions} == {'datasink1'}
+    assert replacement_mapping == {}
+
+
+def test_trimmer_replaces_cached_node(tmp_path):
+    '''[anat] → [registration] →(out)→ [datasink to warped ✔]
+                               ↳(out)→ [apply] → [datasink to func ❌]'''
+    from CPAC.utils.trimmer import the_trimmer
+
+    wf = _trimmer_workflow(tmp_path, [
+        ('anat', 'out', 'registration', 'in1'),
+        ('registration', 'out', 'datasink1', 'warped'),
+        ('registration', 'out', 'apply', 'in1'),
+        ('apply', 'out', 'datasink2', 'func'),
+    ], cached=['warped'])
+
+    wf_new, (replacement_mapping, deletions) = the_trimmer(wf)
+    graph = wf_new._graph
+
+    assert {n.name for n in replacement_mapping} == {'registration'}
+    trim_input = list(replacement_mapping.values())[0]['out']
+    assert trim_input.name == 'check_for_s3_registration_out_triminput'
+    assert trim_input.inputs.file_path == os.path.join(
+        tmp_path, 'sub-1', 'warped', 'out.txt')
+
+    assert {n.name for n in graph.nodes()} == {
+        trim_input.name, 'apply', 'datasink2'}
+    apply = [n for n in graph.nodes() if n.name == 'apply'][0]
+    assert graph[trim_input][apply]['connect'] == [('local_path', 'in1')]
+    assert {n.name for n in deletions} == {'datasink1', 'anat'}
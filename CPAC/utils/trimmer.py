@@ -1,61 +1,158 @@
 # -*- coding: utf-8 -*-
 
-import glob
+import os
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from CPAC.pipeline import nipype_pipeline_engine as pe
+from nipype.interfaces.io import DataSink as NipypeDataSink
 from nipype.interfaces.utility import Function
+from nipype.pipeline.engine import Node as NipypeNode
 from nipype.pipeline.engine.utils import generate_expanded_graph
-import networkx as nx
 
 from indi_aws import fetch_creds
 
 from CPAC.utils.datasource import (
     create_check_for_s3_node,
 )
+from CPAC.utils.interfaces.datasink import DataSink
+
+# Exact classes, so MapNodes and JoinNodes are not mistaken for Nodes
+NODE_TYPES = frozenset({pe.Node, NipypeNode})
+DATASINK_TYPES = frozenset({DataSink, NipypeDataSink})
 
 def expand_workflow(wf):
-    return generate_expanded_graph(deepcopy(wf._create_flat_graph()))
+    # _create_flat_graph already builds its graph from a deep copy of the
+    # workflow, so it can be expanded in place
+    return generate_expanded_graph(wf._create_flat_graph())
 
 def is_datasink(n):
-    return type(n).__name__ == 'Node' and type(n.interface).__name__ == 'DataSink'
+    return type(n) in NODE_TYPES and type(n.interface) in DATASINK_TYPES
+
+def datasink_prefix(datasink, output_dir=None, container=None):
+    datasink_output_dir = datasink.interface.inputs.base_directory
+    if output_dir is not None:
+        datasink_output_dir = output_dir
+
+    datasink_container = datasink.interface.inputs.container
+    if container is not None:
+        datasink_container = container
 
-def compute_datasink_dirs(graph, datasink, output_dir=None, container=None):
+    return '/'.join([datasink_output_dir, datasink_container])
+
+def compute_datasink_dirs(graph, datasink, output_dir=None, container=None,
+                          prefix=None, in_edges=None):
     directories = {}
-    for inp in graph.in_edges(datasink):
-        src, _ = inp
-        for edge in graph.get_edge_data(*inp)['connect']:
-            _, derivative_name = edge
 
-            datasink_output_dir = datasink.interface.inputs.base_directory
-            if output_dir is not None:
-                datasink_output_dir = output_dir
+    # in_edges: (source node, 'connect' list) pairs, if already looked up
+    if in_edges is None:
+        in_edges = [
+            (src, graph.get_edge_data(src, dst)['connect'])
+            for src, dst in graph.in_edges(datasink)
+        ]
+
+    # DataSink traits are slow to read, so callers that already computed
+    # the prefix can pass it in
+    if prefix is None:
+        prefix = datasink_prefix(datasink,
+                                 output_dir=output_dir,
+                                 container=container)
 
-            datasink_container = datasink.interface.inputs.container
-            if container is not None:
-                datasink_container = container
+    iterables = datasink.parameterization
+
+    for src, connect in in_edges:
+        for _, derivative_name in connect:
 
             # Look if there is an output in this datasink directory
 
-            iterables = datasink.parameterization
             path = '/'.join(['', derivative_name] + iterables)
             path = datasink.interface._substitute(path)[1:]
-            path = '/'.join([datasink_output_dir, datasink_container, path])
+            path = '/'.join([prefix, path])
 
             directories[(src, derivative_name)] = path
 
     return directories
 
-def list_files(path, s3_creds_path=None):
+def split_s3_path(path):
+    pieces = path[5:].split('/')
+    return pieces[0], '/'.join(pieces[1:])
+
+def list_s3_keys(prefix, s3_creds_path=None):
+    """
+    List every key under an S3 prefix, sorted, in a single paginated
+    request, so `list_files` can answer for any path below it without
+    going back to S3.
+    """
+    bucket_name, key_prefix = split_s3_path(prefix)
+    bucket = fetch_creds.return_bucket(s3_creds_path, bucket_name)
+    return sorted(
+        obj.key for obj in bucket.objects.filter(Prefix=key_prefix)
+    )
+
+def list_files(path, s3_creds_path=None, s3_keys=None):
     if path.startswith('s3://'):
-        pieces = path[5:].split('/')
-        bucket_name, path = pieces[0], '/'.join(pieces[1:])
-        bucket = fetch_creds.return_bucket(s3_creds_path, bucket_name)
-        return [
-            's3://%s/%s' % (bucket, obj['Key'])
-            for obj in bucket.objects.filter(Prefix=path)
-        ]
+        # s3_keys: sorted keys from `list_s3_keys` for a prefix of path
+        if s3_keys is None:
+            s3_keys = list_s3_keys(path, s3_creds_path=s3_creds_path)
+        bucket_name, path = split_s3_path(path)
+
+        dir_prefix = path.rstrip('/') + '/'
+        files = []
+        for i in range(bisect_left(s3_keys, dir_prefix), len(s3_keys)):
+            if not s3_keys[i].startswith(dir_prefix):
+                break
+            files.append('s3://%s/%s' % (bucket_name, s3_keys[i]))
+        return files
     else:
-        return list(glob.glob(path + '/*'))
+        # Only zero, one or many files matter, so stop at the second entry
+        # instead of reading the whole directory. Hidden files are skipped,
+        # as glob would.
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    files.append(entry.path)
+                    if len(files) == 2:
+                        break
+        except OSError:  # unreadable directories count as empty, as in glob
+            pass
+        return files
+
+def prune_dangling_nodes(graph, deletions, replacements):
+    """
+    Remove the nodes already in `deletions` and, walking backwards from
+    them, every non-datasink node left without outgoing edges.
+
+    Only the predecessors of a removed node are re-examined, so the whole
+    walk is O(V + E) however many cached branches share ancestors.
+    Removed nodes are added to `deletions` and dropped from
+    `replacements`.
+    """
+    doomed = set(deletions)
+    removed = set()
+    stack = [
+        node for node in graph.nodes()
+        if node in doomed or (
+            not is_datasink(node) and graph.out_degree(node) == 0
+        )
+    ]
+    while stack:
+        node = stack.pop()
+        if node in removed:
+            continue
+        if node not in doomed:
+            if is_datasink(node) or graph.out_degree(node) > 0:
+                continue
+            deletions[node] = None
+            if node in replacements:
+                del replacements[node]
+
+        predecessors = list(graph.predecessors(node))
+        graph.remove_node(node)
+        removed.add(node)
+        stack.extend(predecessors)
 
 def the_trimmer(wf, output_dir=None, container=None, s3_creds_path=None):
     """
@@ -160,22 +257,76 @@ def the_trimmer(wf, output_dir=None, container=None, s3_creds_path=None):
     execgraph = expand_workflow(wf)
 
     replacements = {}
-    deletions = []
+    # Keys act as an insertion-ordered set, so a node reached through
+    # several cached branches is only recorded (and removed) once
+    deletions = {}
     
     # Check out for datasinks (i.e. the ones who throws things at the output dir)
     datasinks = [
         n for n in execgraph.nodes()
         if is_datasink(n)
     ]
-    for datasink in datasinks:
 
-        for (src, derivative_name), path in \
-            compute_datasink_dirs(execgraph,
-                                  datasink,
+    # Incoming connections per datasink, looked up once instead of per
+    # edge visit
+    in_adj = {
+        datasink: [
+            (src, edge_data['connect'])
+            for src, edge_data in execgraph.pred[datasink].items()
+        ]
+        for datasink in datasinks
+    }
+
+    prefixes = {
+        datasink: datasink_prefix(datasink,
                                   output_dir=output_dir,
-                                  container=container).items():
+                                  container=container)
+        for datasink in datasinks
+    }
+
+    # List each S3 output prefix once, instead of once per derivative
+    s3_keys = {
+        prefix: list_s3_keys(prefix, s3_creds_path=s3_creds_path)
+        for prefix in set(prefixes.values()) if prefix.startswith('s3://')
+    }
+
+    datasink_dirs = {
+        datasink: compute_datasink_dirs(execgraph,
+                                        datasink,
+                                        prefix=prefixes[datasink],
+                                        in_edges=in_adj[datasink])
+        for datasink in datasinks
+    }
+
+    # Check the output directories concurrently, since on networked
+    # filesystems each directory read is a round-trip
+    path_keys = {
+        path: s3_keys.get(prefixes[datasink])
+        for datasink, directories in datasink_dirs.items()
+        for path in directories.values()
+    }
+    paths = list(path_keys)
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        listed_files = dict(zip(paths, executor.map(
+            lambda path: list_files(path,
+                                    s3_creds_path=s3_creds_path,
+                                    s3_keys=path_keys[path]),
+            paths
+        )))
+
+    for datasink in datasinks:
 
-            files = list_files(path, s3_creds_path=s3_creds_path)
+        in_edges = in_adj[datasink]
+        src_fields = {
+            (src, derivative_name): src_field
+            for src, connect in in_edges
+            for src_field, derivative_name in connect
+        }
+
+        for (src, derivative_name), path in datasink_dirs[datasink].items():
+
+            src_field = src_fields[(src, derivative_name)]
+            files = listed_files[path]
             if len(files) == 1:  # Ignore multi-file nodes
                 if src not in replacements:
                     replacements[src] = {}
@@ -185,92 +336,90 @@ def the_trimmer(wf, output_dir=None, container=None, s3_creds_path=None):
         # if the replacements have all the fields from the datasink, datasink 
         # can be deleted (we do not want to output again the same file :))
         if all(
-            any(
-                field in replacements.get(src, {})
-                for field, _ in execgraph.get_edge_data(src, dst)['connect']
+            src in replacements and
+            not replacements[src].keys().isdisjoint(
+                field for field, _ in connect
             )
-            for src, dst in execgraph.in_edges(datasink)
+            for src, connect in in_edges
         ):
-            deletions += [datasink]
+            deletions[datasink] = None
 
     # Remove from replacement list the nodes that gives other output
     # for other nodes, since it seems like not all fields are cached
+    partially_cached = set()
     for node, cached_fields in replacements.items():
-        for edge in execgraph.out_edges(node):
+        cached_fields = frozenset(cached_fields)
+        for edge_data in execgraph.succ[node].values():
             if any(
                 src_field not in cached_fields
-                for src_field, _ in execgraph.get_edge_data(*edge)['connect']
+                for src_field, _ in edge_data['connect']
             ):
-                del replacements[node]
+                partially_cached.add(node)
                 break
+    for node in partially_cached:
+        del replacements[node]
             
     # Delete them! It also removes the edges, and recursively delete nodes
     # before rationalizing about replacements
-    for node in reversed(nx.topological_sort(execgraph)):
-        if node in deletions:
-            execgraph.remove_node(node)
-        if is_datasink(node):
-            continue
-        
-        if len(execgraph.out_edges(node)) == 0:
-            deletions += [node]
-            if node in replacements:
-                del replacements[node]
-            execgraph.remove_node(node)
-                    
+    prune_dangling_nodes(execgraph, deletions, replacements)
+
     # And now we replace the cached with a data input node, from the 
     # output directory.
     replacement_mapping = {}
+    # Data input nodes, shared by every consumer of the same cached file
+    input_nodes = {}
     for replacement, cached_files in replacements.items():
-        out_edges_data = execgraph.edge[replacement]
-        
         # Get this cached node, and replace all the out-connections
-        # from this node with a data input node
-        out_edges = execgraph.successors(replacement)
+        # from this node with a data input node. Read the graph itself,
+        # since pruning may have removed some of its successors.
+        out_edges = list(execgraph.succ[replacement].items())
         if out_edges:
-            for to_node in out_edges:
-                for from_field, to_field in out_edges_data[to_node]['connect']:
+            hierarchy = deepcopy(replacement._hierarchy)
+            for to_node, edge_data in out_edges:
+                for from_field, to_field in edge_data['connect']:
                     
-                    # Reuse the data input node for this field
+                    # Reuse the data input node for this file
                     if replacement not in replacement_mapping:
                         replacement_mapping[replacement] = {}
                     if from_field not in replacement_mapping[replacement]:
-                
-                        new_node = create_check_for_s3_node(
-                            name='%s_%s_triminput' % (replacement.name, from_field),
-                            file_path=cached_files[from_field],
-                            img_type='other',
-                            creds_path=s3_creds_path,
-                            dl_dir=None
-                        )
-                        new_node._hierarchy = deepcopy(replacement._hierarchy)
-
-                        execgraph.add_node(new_node)
-                        replacement_mapping[replacement][from_field] = new_node
+                        input_key = (cached_files[from_field], s3_creds_path)
+                        if input_key not in input_nodes:
+                            new_node = create_check_for_s3_node(
+                                name='%s_%s_triminput' % (replacement.name, from_field),
+                                file_path=cached_files[from_field],
+                                img_type='other',
+                                creds_path=s3_creds_path,
+                                dl_dir=None
+                            )
+                            new_node._hierarchy = hierarchy
+
+                            execgraph.add_node(new_node)
+                            input_nodes[input_key] = new_node
+                        replacement_mapping[replacement][from_field] = \
+                            input_nodes[input_key]
                 
                     # Connect the new data input node to the node
-                    # it was connected
-                    execgraph.add_edge(
-                        replacement_mapping[replacement][from_field],
-                        to_node,
-                        connect=[('local_path', to_field)]
-                    )
+                    # it was connected, keeping any connection a shared
+                    # input node already has to it
+                    input_node = replacement_mapping[replacement][from_field]
+                    if execgraph.has_edge(input_node, to_node):
+                        execgraph[input_node][to_node]['connect'].append(
+                            ('local_path', to_field)
+                        )
+                    else:
+                        execgraph.add_edge(
+                            input_node,
+                            to_node,
+                            connect=[('local_path', to_field)]
+                        )
 
         execgraph.remove_node(replacement)
         
     # Second round of backtrack deletion, affected by replacements
-    for node in reversed(nx.topological_sort(execgraph)):
-        if is_datasink(node):
-            continue
+    prune_dangling_nodes(execgraph, deletions, replacements)
 
-        if len(execgraph.out_edges(node)) == 0:
-            deletions += [node]
-            if node in replacements:
-                del replacements[node]
-            execgraph.remove_node(node)
-        
     wf_new = wf.clone(wf.name + '_trimmed')
     wf_new.name = wf.name
     wf_new._graph = execgraph
     
-    return wf_new, (replacement_mapping, deletions)
+    return wf_new, (replacement_mapping, list(deletions))
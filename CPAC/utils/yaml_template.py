@@ -1,12 +1,29 @@
 import os
 import re
+import shutil
 import yaml
 from click import BadParameter
+from copy import deepcopy
 from datetime import datetime
+from functools import lru_cache
 from CPAC.utils.configuration import Configuration, DEFAULT_PIPELINE_FILE
 from CPAC.utils.utils import dct_diff, load_preconfig, lookup_nested_value, \
     update_config_dict, update_pipeline_values_1_8
 
+# use libyaml's parser and emitter when PyYAML was built with them
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
+# patterns for parsing template lines
+_RE_COMMENT = re.compile(r'^\s*#.*$')
+_RE_KEY = re.compile(r'^\s*(([a-z0-9A-Z_]+://){0,1}'
+                     r'[a-z0-9A-Z_/][\sa-z0-9A-Z_/\.-]+)\s*:')
+_RE_BASED_ON = re.compile(r'(?<=# based on )(.* pipeline)')
+_RE_BLANK_LINES = re.compile(r'\n{3,}')
+
+# string spellings of bools that `yaml_bool` converts to On/Off
+_YAML_STR_LOOKUP = {'True': 'On', 'False': 'Off'}
+
 
 def create_yaml_from_template(
     d, template=DEFAULT_PIPELINE_FILE, include_all=False
@@ -40,119 +57,9 @@ def create_yaml_from_template(
         ...
     ValueError: 'Lil BUB' is not a valid path nor a defined preconfig.
     """  # noqa: E501 # pylint: disable=line-too-long
-    def _count_indent(line):
-        '''Helper method to determine indentation level
-
-        Parameters
-        ----------
-        line : str
-
-        Returns
-        -------
-        number_of_indents : int
-
-        Examples
-        --------
-        >>> _count_indent('No indent')
-        0
-        >>> _count_indent('    Four spaces')
-        2
-        '''
-        return (len(line) - len(line.lstrip())) // 2
-
-    def _create_import_dict(diff):
-        '''Method to return a dict of only changes given a nested dict
-        of (dict1_value, dict2_value) tuples
-
-        Parameters
-        ----------
-        diff : dict
-            output of `dct_diff`
-
-        Returns
-        -------
-        dict
-            dict of only changed values
-
-        Examples
-        --------
-        >>> _create_import_dict({'anatomical_preproc': {
-        ...     'brain_extraction': {'extraction': {
-        ...         'run': ([True], False),
-        ...         'using': (['3dSkullStrip'], ['niworkflows-ants'])}}}})
-        {'anatomical_preproc': {'brain_extraction': {'extraction': {'run': False, 'using': ['niworkflows-ants']}}}}
-        '''  # noqa: E501  # pylint: disable=line-too-long
-        if isinstance(diff, tuple) and len(diff) == 2:
-            return diff[1]
-        if isinstance(diff, dict):
-            i = {}
-            for k in diff:
-                try:
-                    j = _create_import_dict(diff[k])
-                    if j != {}:
-                        i[k] = j
-                except KeyError:
-                    continue
-            return i
-        return diff
-
-    def _format_key(key, level):
-        '''Helper method to format YAML keys
-
-        Parameters
-        ----------
-        key : str
-        level : int
-
-        Returns
-        -------
-        yaml : str
-
-        Examples
-        --------
-        >>> _format_key('base', 0)
-        '\nbase: '
-        >>> _format_key('indented', 2)
-        '\n    indented:'
-        '''
-        return f'\n{" " * level * 2}{key}: '
-
-    def _format_list_items(l,  # noqa: E741  # pylint:disable=invalid-name
-                           line_level):
-        '''Helper method to handle lists in the YAML
-
-        Parameters
-        ----------
-        l : list
-
-        line_level : int
-
-        Returns
-        -------
-        yaml : str
-
-        Examples
-        --------
-        >>> _format_list_items([1, 2, {'nested': 3}], 0)
-        '  - 1\n  - 2\n  - nested: 3'
-        >>> _format_list_items([1, 2, {'nested': [3, {'deep': [4]}]}], 1)
-        '    - 1\n    - 2\n    - nested:\n      - 3\n      - deep:\n        - 4'
-        '''  # noqa: E501  # pylint: disable=line-too-long
-        # keep short, simple lists in square brackets
-        if all(isinstance(item, (str, bool, int, float)) for item in l):
-            if len(str(l)) < 50:
-                return str(l).replace("'", '').replace('"', '')
-        # list long or complex lists on lines with indented '-' lead-ins
-        return '\n' + '\n'.join([
-            f'{indent(line_level)}{li}' for li in yaml.dump(
-                yaml_bool(l)
-            ).replace("'On'", 'On').replace("'Off'", 'Off').split('\n')
-        ]).rstrip()
-
     # set starting values
-    output = ''
+    output = []
     comment = ''
-    space_match = r'^\s+.*'
     level = 0
     nest = []
     list_item = False
@@ -171,15 +78,35 @@ def create_yaml_from_template(
                              'defined preconfig.') from bad_parameter
     template_included = False
 
-    # load default values
-    d_default = Configuration(yaml.safe_load(open(template, 'r'))).dict()
+    # load default values, reading and parsing the template only once
+    with open(template, 'r') as f:
+        template_text = f.read()
+    template_dict = yaml.load(template_text, Loader=SafeLoader)
+    d_default = Configuration(deepcopy(template_dict)).dict()
 
-    if (
-        template == DEFAULT_PIPELINE_FILE or
-        not dct_diff(
-            yaml.safe_load(open(DEFAULT_PIPELINE_FILE, 'r')), d_default)
-    ):
+    if template == DEFAULT_PIPELINE_FILE:
         template_name = 'default'
+    else:
+        with open(DEFAULT_PIPELINE_FILE, 'r') as f:
+            if not dct_diff(yaml.load(f, Loader=SafeLoader), d_default):
+                template_name = 'default'
+
+    # index every key path in the template, noting which paths end in a
+    # non-dict value (`lookup_nested_value` stops at those rather than
+    # raising a KeyError for deeper keys)
+    template_paths = {(): not isinstance(template_dict, dict)}
+    stack = [((), template_dict)] if isinstance(template_dict, dict) else []
+    while stack:
+        prefix, branch = stack.pop()
+        for k, v in branch.items():
+            template_paths[prefix + (k,)] = not isinstance(v, dict)
+            if isinstance(v, dict):
+                stack.append((prefix + (k,), v))
+
+    def _in_template(keys):
+        keys = tuple(keys)
+        return keys in template_paths or any(
+            template_paths.get(keys[:i]) for i in range(len(keys)))
 
     # update values
     if include_all:
@@ -189,133 +116,270 @@ def create_yaml_from_template(
         d = _create_import_dict(dct_diff(d_default, d))
 
     # generate YAML from template with updated values
-    template_dict = yaml.safe_load(open(template, 'r'))
-    with open(template, 'r') as f:
-        for line in f:
-
-            # persist comments and frontmatter
-            if line.startswith('%') or line.startswith('---') or re.match(
-                r'^\s*#.*$', line
-            ):
-                list_item = False
-                line = line.strip('\n')
-                comment += f'\n{line}'
-            elif len(line.strip()):
-                if re.match(space_match, line):
-                    line_level = _count_indent(line)
-                else:
-                    line_level = 0
-
-                # handle lists as a unit
-                if list_item:
-                    if line_level < list_level - 1:
-                        list_item = False
-                        level = list_level
-                        list_level = 0
-                elif line.lstrip().startswith('-'):
-                    list_item = True
-                    list_level = line_level - 1
-
-                else:
-                    # extract dict key
-                    key_group = re.match(
-                        r'^\s*(([a-z0-9A-Z_]+://){0,1}'
-                        r'[a-z0-9A-Z_/][\sa-z0-9A-Z_/\.-]+)\s*:', line)
-                    if key_group:
-                        if not template_included:
-                            # prepend comment from template
-                            if len(comment.strip()):
-                                comment = re.sub(
-                                    r'(?<=# based on )(.* pipeline)',
-                                    f'{template_name} pipeline',
-                                    comment
-                                )
-                                output += comment
-                                output += f'\nFROM: {template_name}\n'
-                                comment = ''
-                            template_included = True
-                        key = key_group.group(1).strip()
-
-                        # calculate key depth
-                        if line_level == level:
-                            if level > 0:
-                                nest = nest[:-1] + [key]
-                            else:
-                                nest = [key]
-                        elif line_level == level + 1:
-                            nest += [key]
-                        elif line_level < level:
-                            nest = nest[:line_level] + [key]
-
-                        # only include updated and new values
-                        try:
-                            # get updated value for key
-                            value = lookup_nested_value(d, nest)
-                            orig_value = lookup_nested_value(d_default, nest)
-                            # Use 'On' and 'Off' for bools
-                            if (isinstance(orig_value, bool) or (
-                                isinstance(orig_value, str) and
-                                orig_value in {'On', 'Off'}
-                            ) or (isinstance(orig_value, list) and all([(
-                                isinstance(orig_item, bool) or (
-                                    isinstance(orig_item, str) and
-                                    orig_item in {'On', 'Off'}
-                                )
-                            ) for orig_item in orig_value])
-                            )):
-                                value = yaml_bool(value)
-                            # prepend comment from template
-                            if len(comment.strip()):
-                                output += comment
-                            else:
-                                output += '\n'
-
-                            # write YAML
-                            output += _format_key(key, line_level)
-                            if isinstance(value, list):
-                                output += _format_list_items(
-                                    value, line_level)
-                            elif isinstance(value, dict):
-                                for k in value.keys():
-                                    try:
-                                        lookup_nested_value(template_dict,
-                                                            nest + [k])
-                                    # include keys not in template
-                                    except KeyError:
-                                        output += _format_key(
-                                            k, line_level + 1)
-                                        parsed = _format_list_items(
-                                            value[k],
-                                            line_level + 1
-                                        ) if isinstance(
-                                            value[k], list) else yaml_bool(
-                                                value[k])
-                                        if isinstance(parsed, (int, float)):
-                                            parsed = str(parsed)
-                                        elif parsed is None:
-                                            parsed = ''
-                                        output += parsed if (
-                                            isinstance(parsed, str)
-                                        ) else (
-                                            '\n' + indent(line_level + 1) +
-                                            f'\n{indent(line_level + 1)}' +
-                                            yaml.dump(parsed) + '\n')
-                            else:
-                                output += str(value)
-                        except KeyError:
-                            # clear comment for excluded key
-                            comment = '\n'
-
-                        # reset variables for loop
+    for line in template_text.splitlines(keepends=True):
+
+        # persist comments and frontmatter
+        if line.startswith('%') or line.startswith('---') or \
+                _RE_COMMENT.match(line):
+            list_item = False
+            line = line.strip('\n')
+            comment += f'\n{line}'
+        elif len(line.strip()):
+            line_level = _count_indent(line)
+
+            # handle lists as a unit
+            if list_item:
+                if line_level < list_level - 1:
+                    list_item = False
+                    level = list_level
+                    list_level = 0
+            elif line.lstrip().startswith('-'):
+                list_item = True
+                list_level = line_level - 1
+
+            else:
+                # extract dict key
+                key_group = _RE_KEY.match(line)
+                if key_group:
+                    if not template_included:
+                        # prepend comment from template
+                        if len(comment.strip()):
+                            comment = _RE_BASED_ON.sub(
+                                f'{template_name} pipeline', comment)
+                            output.extend([
+                                comment, f'\nFROM: {template_name}\n'])
+                            comment = ''
+                        template_included = True
+                    key = key_group.group(1).strip()
+
+                    # calculate key depth
+                    if line_level == level:
+                        if level > 0:
+                            nest = nest[:-1] + [key]
+                        else:
+                            nest = [key]
+                    elif line_level == level + 1:
+                        nest += [key]
+                    elif line_level < level:
+                        nest = nest[:line_level] + [key]
+
+                    # only include updated and new values
+                    try:
+                        # get updated value for key
+                        value = lookup_nested_value(d, nest)
+                        orig_value = lookup_nested_value(d_default, nest)
+                        # Use 'On' and 'Off' for bools
+                        if (isinstance(orig_value, bool) or (
+                            isinstance(orig_value, str) and
+                            orig_value in {'On', 'Off'}
+                        ) or (isinstance(orig_value, list) and all([(
+                            isinstance(orig_item, bool) or (
+                                isinstance(orig_item, str) and
+                                orig_item in {'On', 'Off'}
+                            )
+                        ) for orig_item in orig_value])
+                        )):
+                            value = yaml_bool(value)
+                        # prepend comment from template
+                        if len(comment.strip()):
+                            output.append(comment)
+                        else:
+                            output.append('\n')
+
+                        # write YAML
+                        output.append(_format_key(key, line_level))
+                        if isinstance(value, list):
+                            output.append(_format_list_items(
+                                value, line_level))
+                        elif isinstance(value, dict):
+                            for k in value.keys():
+                                # include keys not in template
+                                if not _in_template(nest + [k]):
+                                    output.append(_format_key(
+                                        k, line_level + 1))
+                                    parsed = _format_list_items(
+                                        value[k],
+                                        line_level + 1
+                                    ) if isinstance(
+                                        value[k], list) else yaml_bool(
+                                            value[k])
+                                    if isinstance(parsed, (int, float)):
+                                        parsed = str(parsed)
+                                    elif parsed is None:
+                                        parsed = ''
+                                    output.append(parsed if (
+                                        isinstance(parsed, str)
+                                    ) else (
+                                        '\n' + indent(line_level + 1) +
+                                        f'\n{indent(line_level + 1)}' +
+                                        yaml.dump(parsed, Dumper=Dumper) +
+                                        '\n'))
+                        else:
+                            output.append(str(value))
+                    except KeyError:
+                        # clear comment for excluded key
                         comment = '\n'
-                        level = line_level
-            elif len(comment) > 1 and comment[-2] != '\n':
-                comment += '\n'
-    while '\n\n\n' in output:
-        output = output.replace('\n\n\n', '\n\n')
+
+                    # reset variables for loop
+                    comment = '\n'
+                    level = line_level
+        elif len(comment) > 1 and comment[-2] != '\n':
+            comment += '\n'
+    output = _RE_BLANK_LINES.sub('\n\n', ''.join(output))
     return output.lstrip('\n').replace('null', '')
 
 
+def _count_indent(line):
+    '''Helper method to determine indentation level
+
+    Parameters
+    ----------
+    line : str
+
+    Returns
+    -------
+    number_of_indents : int
+
+    Examples
+    --------
+    >>> _count_indent('No indent')
+    0
+    >>> _count_indent('    Four spaces')
+    2
+    '''
+    return (len(line) - len(line.lstrip())) // 2
+
+
+def _create_import_dict(diff):
+    '''Method to return a dict of only changes given a nested dict
+    of (dict1_value, dict2_value) tuples
+
+    Parameters
+    ----------
+    diff : dict
+        output of `dct_diff`
+
+    Returns
+    -------
+    dict
+        dict of only changed values
+
+    Examples
+    --------
+    >>> _create_import_dict({'anatomical_preproc': {
+    ...     'brain_extraction': {'extraction': {
+    ...         'run': ([True], False),
+    ...         'using': (['3dSkullStrip'], ['niworkflows-ants'])}}}})
+    {'anatomical_preproc': {'brain_extraction': {'extraction': {'run': False, 'using': ['niworkflows-ants']}}}}
+    '''  # noqa: E501  # pylint: disable=line-too-long
+    if isinstance(diff, tuple) and len(diff) == 2:
+        return diff[1]
+    if not isinstance(diff, dict):
+        return diff
+    # walk the nested diff with an explicit stack rather than recursion
+    import_dict = {}
+    branches = []
+    stack = [(diff, import_dict)]
+    while stack:
+        node, parent = stack.pop()
+        for key, value in node.items():
+            if isinstance(value, tuple) and len(value) == 2:
+                value = value[1]
+            elif isinstance(value, dict):
+                parent[key] = {}
+                branches.append((parent, key))
+                stack.append((value, parent[key]))
+                continue
+            if value != {}:
+                parent[key] = value
+    # drop branches without changes, deepest first
+    for parent, key in reversed(branches):
+        if parent[key] == {}:
+            del parent[key]
+    return import_dict
+
+
+def _format_key(key, level):
+    r'''Helper method to format YAML keys
+
+    Parameters
+    ----------
+    key : str
+    level : int
+
+    Returns
+    -------
+    yaml : str
+
+    Examples
+    --------
+    >>> _format_key('base', 0)
+    '\nbase: '
+    >>> _format_key('indented', 2)
+    '\n    indented: '
+    '''
+    return f'\n{" " * level * 2}{key}: '
+
+
+def _format_list_items(l,  # noqa: E741  # pylint:disable=invalid-name
+                       line_level):
+    r'''Helper method to handle lists in the YAML
+
+    Lists of hashable items are formatted once per distinct list and
+    indentation level.
+
+    Parameters
+    ----------
+    l : list
+
+    line_level : int
+
+    Returns
+    -------
+    yaml : str
+
+    Examples
+    --------
+    >>> _format_list_items([1, 2, {'nested': 3}], 0)
+    '\n  - 1\n  - 2\n  - nested: 3'
+    >>> _format_list_items([1, 2, {'nested': [3, {'deep': [4]}]}], 1)
+    '\n    - 1\n    - 2\n    - nested:\n      - 3\n      - deep:\n        - 4'
+    >>> _format_list_items(['On', 'Off'], 2)
+    '[On, Off]'
+    >>> _format_list_items([True, 1], 0)
+    '[True, 1]'
+    >>> _format_list_items([0.0], 0), _format_list_items([-0.0], 0)
+    ('[0.0]', '[-0.0]')
+    '''  # noqa: E501  # pylint: disable=line-too-long
+    # key on each item's repr too, so equal values that format
+    # differently (True and 1, 0.0 and -0.0) don't share a cache entry
+    try:
+        return _format_hashable_list_items(
+            tuple((repr(item), item) for item in l), line_level)
+    except TypeError:  # unhashable items
+        return _list_items_to_yaml(l, line_level)
+
+
+@lru_cache(maxsize=4096)
+def _format_hashable_list_items(keyed_items, line_level):
+    return _list_items_to_yaml([item for _, item in keyed_items], line_level)
+
+
+def _list_items_to_yaml(l,  # noqa: E741  # pylint:disable=invalid-name
+                        line_level):
+    # keep short, simple lists in square brackets
+    if all(isinstance(item, (str, bool, int, float)) for item in l):
+        flow = str(l)
+        if len(flow) < 50:
+            return flow.replace("'", '').replace('"', '')
+    # list long or complex lists on lines with indented '-' lead-ins
+    return '\n' + '\n'.join([
+        f'{indent(line_level)}{li}' for li in yaml.dump(
+            yaml_bool(l), Dumper=Dumper
+        ).replace("'On'", 'On').replace("'Off'", 'Off').split('\n')
+    ]).rstrip()
+
+
 def indent(line_level):
     '''Function to return an indent string for a given level
 
@@ -349,17 +413,18 @@ def yaml_bool(value):
     'On'
     >>> yaml_bool([False, 'On', True])
     ['Off', 'On', 'On']
+    >>> yaml_bool({'run': 'False', 'threshold': 1})
+    {'run': 'Off', 'threshold': 1}
     '''
-    yaml_lookup = {
-        True: 'On', 'True': 'On', 1: 'On',
-        False: 'Off', 'False': 'Off', 0: 'Off'}
-    if (
-        isinstance(value, bool) or isinstance(value, str)
-    ) and value in yaml_lookup:
-        return yaml_lookup[value]
-    elif isinstance(value, list):
+    if value is True:
+        return 'On'
+    if value is False:
+        return 'Off'
+    if isinstance(value, str):
+        return _YAML_STR_LOOKUP.get(value, value)
+    if isinstance(value, list):
         return [yaml_bool(item) for item in value]
-    elif isinstance(value, dict):
+    if isinstance(value, dict):
         return {k: yaml_bool(value[k]) for k in value}
     return value
 
@@ -387,8 +452,10 @@ def upgrade_pipeline_to_1_8(path):
     now = datetime.isoformat(datetime.now()).replace(':', '_')
     backup = f'{path}.{now}.bak'
     print(f'Backing up {path} to {backup} and upgrading to C-PAC 1.8')
-    original = open(path, 'r').read()
-    open(backup, 'w').write(original)
+    with open(path, 'r') as f:
+        original = f.read()
+    with open(backup, 'w') as f:
+        f.write(original)
     # upgrade and overwrite
     orig_dict = yaml.safe_load(original)
     # set Regressor 'Name's if not provided
@@ -400,8 +467,21 @@ def upgrade_pipeline_to_1_8(path):
     if 'pipelineName' in orig_dict and len(original.strip()):
         middle_dict, leftovers_dict, complete_dict = update_config_dict(
             orig_dict)
-        open(path, 'w').write(create_yaml_from_template(
+        upgraded = create_yaml_from_template(
             update_pipeline_values_1_8(middle_dict))
-        )
+        # write to a temporary file first so a failure can't leave a
+        # partially written config, replacing the symlink target (if any)
+        # and keeping its mode like writing to `path` directly would
+        target = os.path.realpath(path)
+        tmp = f'{target}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(upgraded)
+            shutil.copymode(target, tmp)
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
         if leftovers_dict:
-            open(f'{path}.rem', 'w').write(yaml.dump(leftovers_dict))
+            with open(f'{path}.rem', 'w') as f:
+                f.write(yaml.dump(leftovers_dict))